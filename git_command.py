@@ -15,14 +15,22 @@
 
 from __future__ import print_function
 #import fcntl
+import collections
+import errno
 import os
-import select
+import pickle
+import shutil
 import sys
 import subprocess
 import portable
 import tempfile
 from signal import SIGTERM
+try:
+  import threading as _threading
+except ImportError:
+  import dummy_threading as _threading
 from error import GitError
+from pyversion import is_python3
 from trace import REPO_TRACE, IsTrace, Trace
 from wrapper import Wrapper
 
@@ -30,6 +38,20 @@ GIT = 'git'
 MIN_GIT_VERSION = (1, 5, 4)
 GIT_DIR = 'GIT_DIR'
 
+# Variables from our own environment that must not leak into git.
+_CLEAN_ENV = frozenset([
+  REPO_TRACE,
+  GIT_DIR,
+  'GIT_ALTERNATE_OBJECT_DIRECTORIES',
+  'GIT_OBJECT_DIRECTORY',
+  'GIT_WORK_TREE',
+  'GIT_GRAFT_FILE',
+  'GIT_INDEX_FILE',
+])
+
+_GIT_ALLOW_PROTOCOL = \
+  'file:git:http:https:ssh:persistent-http:persistent-https:sso:rpc'
+
 LAST_GITDIR = None
 LAST_CWD = None
 
@@ -67,6 +89,26 @@ def _remove_ssh_client(p):
   except ValueError:
     pass
 
+def _exit_ssh_masters():
+  d = ssh_sock(create=False)
+  if not d:
+    return
+  d = os.path.dirname(d)
+  try:
+    socks = os.listdir(d)
+  except OSError:
+    return
+  with open(os.devnull, 'w') as devnull:
+    for name in socks:
+      # The ControlPath is literal here, so the host argument is ignored.
+      command = ['ssh', '-o', 'ControlPath %s' % os.path.join(d, name),
+                 '-O', 'exit', 'localhost']
+      try:
+        Trace(': %s', ' '.join(command))
+        subprocess.call(command, stdout=devnull, stderr=devnull)
+      except OSError:
+        pass
+
 def terminate_ssh_clients():
   global _ssh_clients
   for p in _ssh_clients:
@@ -76,8 +118,56 @@ def terminate_ssh_clients():
     except OSError:
       pass
   _ssh_clients = []
+  _exit_ssh_masters()
 
 _git_version = None
+_spawn_git_path = None
+
+def _spawn_git():
+  """Absolute path of git if Popen can start it with posix_spawn()."""
+  global _spawn_git_path
+  if _spawn_git_path is None:
+    _spawn_git_path = ''
+    which = getattr(shutil, 'which', None)
+    if hasattr(os, 'posix_spawn') and which:
+      _spawn_git_path = which(GIT) or ''
+  return _spawn_git_path
+
+# Parsed `git --version`, cached across runs as (exe, mtime, version).
+_GIT_VERSION_CACHE = os.path.expanduser('~/.repoconfig-esrlabs/git-version')
+
+def _git_version_key():
+  """Identify the git on PATH by its resolved path and mtime."""
+  which = getattr(shutil, 'which', None)
+  if which is None:
+    return None
+  exe = which(GIT)
+  if not exe:
+    return None
+  exe = os.path.realpath(exe)
+  try:
+    return (exe, os.stat(exe).st_mtime)
+  except OSError:
+    return None
+
+def _read_git_version_cache(key):
+  try:
+    with open(_GIT_VERSION_CACHE, 'rb') as f:
+      exe, mtime, version = pickle.load(f)
+  except Exception:
+    return None
+  if (exe, mtime) != key:
+    return None
+  return version
+
+def _write_git_version_cache(key, version):
+  tmp = _GIT_VERSION_CACHE + '.tmp'
+  try:
+    with open(tmp, 'wb') as f:
+      pickle.dump((key[0], key[1], version), f, 2)
+    portable.rename(tmp, _GIT_VERSION_CACHE)
+  except (IOError, OSError):
+    pass
 
 # class _sfd(object):
 #   """select file descriptor class"""
@@ -101,20 +191,30 @@ class _GitCall(object):
 
   def version_tuple(self):
     global _git_version
+    if _git_version is None:
+      key = _git_version_key()
+      if key is not None:
+        _git_version = _read_git_version_cache(key)
     if _git_version is None:
       ver_str = git.version()
       _git_version = Wrapper().ParseGitVersion(ver_str)
       if _git_version is None:
         print('fatal: "%s" unsupported' % ver_str, file=sys.stderr)
         sys.exit(1)
+      if key is not None:
+        _write_git_version_cache(key, _git_version)
     return _git_version
 
+  # Runners built by __getattr__, keyed by attribute name.
+  _cache = {}
+
   def __getattr__(self, name):
-    name = name.replace('_','-')
-    def fun(*cmdv):
-      command = [name]
-      command.extend(cmdv)
-      return GitCommand(None, command).Wait() == 0
+    fun = _GitCall._cache.get(name)
+    if fun is None:
+      prefix = (name.replace('_','-'),)
+      def fun(*cmdv):
+        return GitCommand(None, prefix + cmdv, inherit_output=True).Wait() == 0
+      _GitCall._cache[name] = fun
     return fun
 git = _GitCall()
 
@@ -128,6 +228,126 @@ def git_require(min_version, fail=False):
     sys.exit(1)
   return False
 
+class GitBatchCat(object):
+  """Object and ref lookups in one repository without forking git per query.
+
+  Queries are answered by long-lived `git cat-file --batch-check` and
+  `git cat-file --batch` processes, started on first use.
+  """
+  def __init__(self, gitdir):
+    self.gitdir = gitdir
+    self._procs = {}
+    self._closed = False
+    self._lock = _threading.Lock()
+
+  def _Start(self, mode):
+    env = dict((k, v) for k, v in os.environ.items() if k not in _CLEAN_ENV)
+    env[GIT_DIR] = self.gitdir
+    command = [GIT, 'cat-file', mode]
+    Trace(': export GIT_DIR=%s\n: %s 0<| 1>|', self.gitdir, ' '.join(command))
+    # Nothing reads cat-file's stderr, so send it where it cannot fill a
+    # pipe and block the child (e.g. "refname is ambiguous" warnings).
+    with open(os.devnull, 'wb') as devnull:
+      try:
+        return subprocess.Popen(command,
+                                env = env,
+                                stdin = subprocess.PIPE,
+                                stdout = subprocess.PIPE,
+                                stderr = devnull)
+      except Exception as e:
+        raise GitError('cat-file: %s' % e)
+
+  def _Query(self, mode, name):
+    if self._closed:
+      raise GitError('cat-file %s: %s closed' % (mode, self.gitdir))
+    p = self._procs.get(mode)
+    if p is None:
+      p = self._Start(mode)
+      self._procs[mode] = p
+    try:
+      p.stdin.write(('%s\n' % name).encode('utf-8'))
+      p.stdin.flush()
+      header = p.stdout.readline()
+    except (IOError, OSError):
+      header = None
+    if not header:
+      self._Close(mode)
+      raise GitError('cat-file %s: %s exited' % (mode, self.gitdir))
+    parts = header.decode('utf-8').split()
+    if len(parts) != 3:
+      # "<name> missing" or "<name> ambiguous"
+      return p, None
+    return p, (parts[0], parts[1], int(parts[2]))
+
+  def Resolve(self, name):
+    """Return (objectname, objecttype, objectsize) for name, or None."""
+    if '\n' in name:
+      return None
+    with self._lock:
+      return self._Query('--batch-check', name)[1]
+
+  def Read(self, name):
+    """Return (objecttype, contents) of the object name, or None."""
+    if '\n' in name:
+      return None
+    with self._lock:
+      p, info = self._Query('--batch', name)
+      if info is None:
+        return None
+      data = p.stdout.read(info[2])
+      p.stdout.read(1)
+    return info[1], data
+
+  def _Close(self, mode):
+    p = self._procs.pop(mode, None)
+    if p is None:
+      return
+    for f in (p.stdin, p.stdout):
+      try:
+        f.close()
+      except (IOError, OSError):
+        pass
+    p.wait()
+
+  def Close(self):
+    """Stop the cat-file processes; later queries raise GitError."""
+    with self._lock:
+      self._closed = True
+      for mode in list(self._procs):
+        self._Close(mode)
+
+# Each GitBatchCat holds up to two processes and four pipe ends, so only
+# the most recently used few are kept; the rest are closed to stay well
+# clear of the open file limit when every project is queried in turn.
+_BATCH_CAT_MAX = 8
+_batch_cats = collections.OrderedDict()
+_batch_cats_lock = _threading.Lock()
+
+def batch_cat(gitdir):
+  """Return the shared GitBatchCat for gitdir.
+
+  Only worth it for callers making many lookups in the same repository;
+  a single lookup is cheaper with a plain `git rev-parse`.
+  """
+  evicted = []
+  with _batch_cats_lock:
+    b = _batch_cats.pop(gitdir, None)
+    if b is None:
+      b = GitBatchCat(gitdir)
+      while len(_batch_cats) >= _BATCH_CAT_MAX:
+        evicted.append(_batch_cats.popitem(last=False)[1])
+    _batch_cats[gitdir] = b
+  # Reap outside the lock so other threads are not held up waiting on it.
+  for old in evicted:
+    old.Close()
+  return b
+
+def terminate_batch_cats():
+  with _batch_cats_lock:
+    for b in _batch_cats.values():
+      b.Close()
+    _batch_cats.clear()
+
 def _setenv(env, name, value):
   env[name] = value.encode()
 
@@ -142,24 +362,19 @@ class GitCommand(object):
                disable_editor = False,
                ssh_proxy = False,
                cwd = None,
-               gitdir = None):
+               gitdir = None,
+               inherit_output = False):
     env = os.environ.copy()
 
-    for key in [REPO_TRACE,
-              GIT_DIR,
-              'GIT_ALTERNATE_OBJECT_DIRECTORIES',
-              'GIT_OBJECT_DIRECTORY',
-              'GIT_WORK_TREE',
-              'GIT_GRAFT_FILE',
-              'GIT_INDEX_FILE']:
-      if key in env:
+    if not _CLEAN_ENV.isdisjoint(env):
+      for key in _CLEAN_ENV.intersection(env):
         del env[key]
 
     # If we are not capturing std* then need to print it.
     self.tee = {'stdout': not capture_stdout, 'stderr': not capture_stderr}
 
     if disable_editor:
-      _setenv(env, 'GIT_EDITOR', ':')
+      env['GIT_EDITOR'] = ':'
     if ssh_proxy:
       _setenv(env, 'REPO_SSH_SOCK', ssh_sock())
       _setenv(env, 'GIT_SSH', _ssh_proxy())
@@ -170,8 +385,7 @@ class GitCommand(object):
         s = p + ' ' + s
       _setenv(env, 'GIT_CONFIG_PARAMETERS', s)
     if 'GIT_ALLOW_PROTOCOL' not in env:
-      _setenv(env, 'GIT_ALLOW_PROTOCOL',
-              'file:git:http:https:ssh:persistent-http:persistent-https:sso:rpc')
+      env['GIT_ALLOW_PROTOCOL'] = _GIT_ALLOW_PROTOCOL
 
     if project:
       if not cwd:
@@ -179,26 +393,36 @@ class GitCommand(object):
       if not gitdir:
         gitdir = project.gitdir
 
-    command = [GIT]
     if bare:
       if gitdir:
         _setenv(env, GIT_DIR, gitdir)
       cwd = None
-    command.append(cmdv[0])
+    command = [GIT]
+    command.extend(cmdv)
     # Need to use the --progress flag for fetch/clone so output will be
     # displayed as by default git only does progress output if stderr is a TTY.
-    if sys.stderr.isatty() and cmdv[0] in ('fetch', 'clone'):
+    if cmdv[0] in ('fetch', 'clone') and sys.stderr.isatty():
       if '--progress' not in cmdv and '--quiet' not in cmdv:
-        command.append('--progress')
-    command.extend(cmdv[1:])
+        command.insert(2, '--progress')
 
     if provide_stdin:
       stdin = subprocess.PIPE
     else:
       stdin = None
 
-    stdout = subprocess.PIPE
-    stderr = subprocess.PIPE
+    # When the caller only wants git's output shown, never inspected, let
+    # git write straight to our stdout/stderr: no pipes to create and drain.
+    # Not on Windows, where sys.stdout may be redirected in-process.
+    self._fast = inherit_output \
+      and not (capture_stdout or capture_stderr or provide_stdin) \
+      and not IsTrace() \
+      and portable.isUnix()
+    if self._fast:
+      stdout = None
+      stderr = None
+    else:
+      stdout = subprocess.PIPE
+      stderr = subprocess.PIPE
 
     if IsTrace():
       global LAST_CWD
@@ -228,15 +452,37 @@ class GitCommand(object):
         dbg += ' 2>|'
       Trace('%s', dbg)
 
+    executable = None
+    close_fds = True
+    spawn_git = _spawn_git()
+    if spawn_git and (not cwd or git_require((1, 8, 5))):
+      # Popen only takes the posix_spawn() path, which avoids copying our
+      # page tables as fork() does, for an absolute executable with no cwd
+      # and close_fds=False.  Let git change directory itself; the pipes
+      # Python creates are non-inheritable, so nothing leaks to the child.
+      if cwd:
+        if not os.path.isdir(cwd):
+          # Fail the way Popen's chdir() would; `git -C` would only exit
+          # with 128, which callers expecting an exception would miss.
+          code = errno.ENOTDIR if os.path.exists(cwd) else errno.ENOENT
+          raise GitError('%s: %s' % (cmdv[0],
+                                     OSError(code, os.strerror(code), cwd)))
+        command[1:1] = ['-C', cwd]
+        cwd = None
+      executable = spawn_git
+      close_fds = False
+
     try:
       p = subprocess.Popen(command,
+                           executable = executable,
+                           close_fds = close_fds,
                            cwd = cwd,
                            env = env,
                            stdin = stdin,
                            stdout = stdout,
                            stderr = stderr)
     except Exception as e:
-      raise GitError('%s: %s' % (command[1], e))
+      raise GitError('%s: %s' % (cmdv[0], e))
 
     if ssh_proxy:
       _add_ssh_client(p)
@@ -247,7 +493,12 @@ class GitCommand(object):
   def Wait(self):
     try:
       p = self.process
-      rc = self._CaptureOutput()
+      if self._fast:
+        self.stdout = ''
+        self.stderr = ''
+        rc = p.wait()
+      else:
+        rc = self._CaptureOutput()
     finally:
       _remove_ssh_client(p)
     return rc
@@ -258,28 +509,19 @@ class GitCommand(object):
     #         _sfd(p.stderr, sys.stderr, 'stderr')]
     s_in = [portable.input_reader(p.stdout, sys.stdout, 'stdout'),
             portable.input_reader(p.stderr, sys.stderr, 'stderr')]
-    self.stdout = ''
-    self.stderr = ''
-
-    # for s in s_in:
-    #   flags = fcntl.fcntl(s.fd, fcntl.F_GETFL)
-    #   fcntl.fcntl(s.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-
-    while s_in:
-      in_ready, _, _ = select.select(s_in, [], [])
-      for s in in_ready:
-        # buf = s.fd.read(4096)
-        buf = s.read(4096)
-        if not buf:
-          s_in.remove(s)
-          continue
+    bufs = {'stdout': bytearray(), 'stderr': bytearray()}
+
+    for s, buf in portable.read_pipes(s_in):
+      bufs[s.std_name].extend(buf)
+      if self.tee[s.std_name]:
         if not hasattr(buf, 'encode'):
           buf = buf.decode()
-        if s.std_name == 'stdout':
-          self.stdout += buf
-        else:
-          self.stderr += buf
-        if self.tee[s.std_name]:
-          s.dest.write(buf)
-          s.dest.flush()
+        s.dest.write(buf)
+        s.dest.flush()
+    if is_python3():
+      self.stdout = bufs['stdout'].decode('utf-8', 'replace')
+      self.stderr = bufs['stderr'].decode('utf-8', 'replace')
+    else:
+      self.stdout = str(bufs['stdout'])
+      self.stderr = str(bufs['stderr'])
     return p.wait()
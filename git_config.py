@@ -26,7 +26,6 @@ try:
   import threading as _threading
 except ImportError:
   import dummy_threading as _threading
-import time
 
 from pyversion import is_python3
 if is_python3():
@@ -39,7 +38,6 @@ else:
   urllib.request = urllib2
   urllib.error = urllib2
 
-from signal import SIGTERM
 from error import GitError, UploadError
 from trace import Trace
 if is_python3():
@@ -381,11 +379,13 @@ class RefSpec(object):
     return s
 
 
-_master_processes = []
 _master_keys = set()
 _ssh_master = True
 _master_keys_lock = None
 
+# How long an idle ssh master outlives the connections that used it.
+_SSH_CONTROL_PERSIST = '600s'
+
 def init_ssh():
   """Should be called once at the start of repo to init ssh master handling.
 
@@ -452,8 +452,12 @@ def _open_ssh(host, port=None):
       # to the log there.
       pass
 
+    # With ControlPersist the master puts itself in the background once the
+    # connection is up, so waiting for this ssh to exit tells us whether the
+    # master is ready before any fetch tries to share it.  It keeps running
+    # until terminate_ssh_clients() sends it 'ssh -O exit'.
     command = command_base[:1] + \
-              ['-M', '-N'] + \
+              ['-M', '-N', '-o', 'ControlPersist %s' % _SSH_CONTROL_PERSIST] + \
               command_base[1:]
     try:
       Trace(': %s', ' '.join(command))
@@ -464,12 +468,9 @@ def _open_ssh(host, port=None):
              % (host,port, str(e)), file=sys.stderr)
       return False
 
-    time.sleep(1)
-    ssh_died = (p.poll() is not None)
-    if ssh_died:
+    if p.wait() != 0:
       return False
 
-    _master_processes.append(p)
     _master_keys.add(key)
     return True
   finally:
@@ -479,14 +480,6 @@ def close_ssh():
   global _master_keys_lock
 
   terminate_ssh_clients()
-
-  for p in _master_processes:
-    try:
-      os.kill(p.pid, SIGTERM)
-      p.wait()
-    except OSError:
-      pass
-  del _master_processes[:]
   _master_keys.clear()
 
   d = ssh_sock(create=False)
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import os
+import re
 from trace import Trace
 
 HEAD    = 'HEAD'
@@ -22,6 +23,27 @@ R_TAGS  = 'refs/tags/'
 R_PUB   = 'refs/published/'
 R_M     = 'refs/remotes/m/'
 
+# Matches anything git check-ref-format rejects in a full ref name:
+# components starting with '.' or ending in '.lock', '..', control
+# characters, space and ~^:?*[\, '@{', empty components, a leading or
+# trailing '/', a trailing '.', and names of a single component (which
+# also covers '' and '@').
+_BAD_REF_RE = re.compile(r'(?:^|/)\.|\.lock(?:/|$)|\.\.|'
+                         r'[\x00-\x20\x7f~^:?*[\\]|@\{|//|^/|/$|\.$|'
+                         r'^[^/]*$')
+
+
+def CheckRefFormat(refname):
+  """Validate refname the way 'git check-ref-format' would, in process.
+
+     Setting REPO_GIT_CHECK_REF_FORMAT in the environment runs the git
+     command instead.
+  """
+  if 'REPO_GIT_CHECK_REF_FORMAT' in os.environ:
+    from git_command import git
+    return git.check_ref_format(refname)
+  return not _BAD_REF_RE.search(refname)
+
 
 class GitRefs(object):
   def __init__(self, gitdir):
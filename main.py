@@ -40,7 +40,7 @@ except ImportError:
 
 from color import SetDefaultColoring
 from trace import SetTrace
-from git_command import git, GitCommand
+from git_command import git, GitCommand, terminate_batch_cats
 from git_config import init_ssh, close_ssh
 from command import InteractiveCommand
 from command import MirrorSafeCommand
@@ -512,6 +512,7 @@ def _Main(argv):
       result = repo._Run(argv) or 0
     finally:
       close_ssh()
+      terminate_batch_cats()
   except KeyboardInterrupt:
     print('aborted by user', file=sys.stderr)
     result = 1
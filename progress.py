@@ -48,7 +48,7 @@ class Progress(object):
         self._done))
       sys.stderr.flush()
     else:
-      p = (100 * self._done) / self._total
+      p = (100 * self._done) // self._total
 
       if self._lastp != p:
         self._lastp = p
@@ -69,7 +69,7 @@ class Progress(object):
         self._done))
       sys.stderr.flush()
     else:
-      p = (100 * self._done) / self._total
+      p = (100 * self._done) // self._total
       sys.stderr.write('\r%s: %3d%% (%d%s/%d%s), done.  \n' % (
         self._title,
         p,
@@ -14,26 +14,54 @@
 # limitations under the License.
 
 from __future__ import print_function
+import collections
 import errno
 #import fcntl
 import multiprocessing
 import re
 import os
-import select
+import pickle
 import signal
+import string
 import sys
 import subprocess
+import tempfile
 import portable
 
 from color import Coloring
 from command import Command, MirrorSafeCommand
+from pyversion import is_python3
 
-_CAN_COLOR = [
+_CAN_COLOR = frozenset([
   'branch',
   'diff',
   'grep',
   'log',
-]
+])
+
+# A command made only of these characters is run directly, without a shell.
+_SAFE_CHARS = frozenset(string.ascii_letters + string.digits + '_/.-')
+
+_SHELL_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+_persistent_shell = None
+
+# Per-worker state, set up by InitWorker.
+_header_printed = None
+_project_columns = None
+_work_args = None
+
+# What DoWork needs to know about a project; see _SerializeProject.
+_ProjectInfo = collections.namedtuple('_ProjectInfo', [
+  'name',
+  'relpath',
+  'remote_name',
+  'lrev',
+  'rrev',
+  'annotations',
+  'gitdir',
+  'worktree',
+])
 
 
 class ForallColoring(Coloring):
@@ -42,6 +70,11 @@ class ForallColoring(Coloring):
     self.project = self.printer('project', attr='bold')
 
 
+class ColorCmd(Coloring):
+  def __init__(self, config, cmd):
+    Coloring.__init__(self, config, cmd)
+
+
 class Forall(Command, MirrorSafeCommand):
   common = False
   helpSummary = "Run a shell command in each project"
@@ -154,24 +187,25 @@ without iterating through the remaining projects.
     """ Serialize a project._GitGetByExec instance.
 
     project._GitGetByExec is not pickle-able. Instead of trying to pass it
-    around between processes, make a dict ourselves containing only the
-    attributes that we need.
+    around between processes, make a tuple ourselves containing only the
+    attributes that we need.  Values are never None, so DoWork can put
+    them into the environment as they are.
 
     """
     if not self.manifest.IsMirror:
       lrev = project.GetRevisionId()
     else:
       lrev = None
-    return {
-      'name': project.name,
-      'relpath': project.relpath,
-      'remote_name': project.remote.name,
-      'lrev': lrev,
-      'rrev': project.revisionExpr,
-      'annotations': dict((a.name, a.value) for a in project.annotations),
-      'gitdir': project.gitdir,
-      'worktree': project.worktree,
-    }
+    return _ProjectInfo(
+      name=project.name,
+      relpath=project.relpath,
+      remote_name=project.remote.name,
+      lrev=lrev or '',
+      rrev=project.revisionExpr or '',
+      annotations=dict((a.name, a.value or '') for a in project.annotations),
+      gitdir=project.gitdir,
+      worktree=project.worktree,
+    )
 
   def Execute(self, opt, args):
     if not opt.command:
@@ -180,7 +214,7 @@ without iterating through the remaining projects.
     cmd = [opt.command[0]]
 
     shell = True
-    if re.compile(r'^[a-z0-9A-Z_/\.-]+$').match(cmd[0]):
+    if cmd[0] and _SAFE_CHARS.issuperset(cmd[0]):
       shell = False
 
     if shell:
@@ -195,19 +229,10 @@ without iterating through the remaining projects.
       # command line because we are going to wrap the command into
       # a pipe and git won't know coloring should activate.
       #
-      for cn in cmd[1:]:
-        if not cn.startswith('-'):
-          break
-      else:
-        cn = None
-      # pylint: disable=W0631
-      if cn and cn in _CAN_COLOR:
-        class ColorCmd(Coloring):
-          def __init__(self, config, cmd):
-            Coloring.__init__(self, config, cmd)
+      cn = next((c for c in cmd[1:] if not c.startswith('-')), None)
+      if cn in _CAN_COLOR:
         if ColorCmd(self.manifest.manifestProject.config, cn).is_on:
           cmd.insert(cmd.index(cn) + 1, '--color')
-      # pylint: enable=W0631
 
     mirror = self.manifest.IsMirror
     rc = 0
@@ -228,58 +253,119 @@ without iterating through the remaining projects.
 
     os.environ['REPO_COUNT'] = str(len(projects))
 
-    pool = multiprocessing.Pool(opt.jobs, InitWorker)
+    # Serialize every project once into a file each worker loads in full
+    # when it starts, so that a task only has to carry the project's index.
+    index_path = None
     try:
+      try:
+        index_path, count = self._WriteProjectIndex(projects)
+      except KeyboardInterrupt:
+        # Don't run the command on the projects listed before Ctrl-C.
+        sys.exit(errno.EINTR)
+
+      # Hand projects to the workers in batches, and take results in
+      # whatever order they finish so a slow project does not hold up the
+      # others.  A worker only reports back once its whole batch is done,
+      # so with --abort-on-errors send one project at a time, letting the
+      # first failure stop the run before any more commands start.
+      if opt.abort_on_errors:
+        chunksize = 1
+      else:
+        chunksize = max(1, count // (opt.jobs * 4))
       config = self.manifest.manifestProject.config
-      results_it = pool.imap(
-         DoWorkWrapper,
-         self.ProjectArgs(projects, mirror, opt, cmd, shell, config))
-      pool.close()
-      for r in results_it:
-        rc = rc or r
-        if r != 0 and opt.abort_on_errors:
-          raise Exception('Aborting due to previous error')
-    except (KeyboardInterrupt, WorkerKeyboardInterrupt):
-      # Catch KeyboardInterrupt raised inside and outside of workers
-      print('Interrupted - terminating the pool')
-      pool.terminate()
-      rc = rc or errno.EINTR
-    except Exception as e:
-      # Catch any other exceptions raised
-      print('Got an error, terminating the pool: %s: %s' %
-              (type(e).__name__, e),
-            file=sys.stderr)
-      pool.terminate()
-      rc = rc or getattr(e, 'errno', 1)
+      pool = multiprocessing.Pool(opt.jobs, InitWorker,
+                                  (multiprocessing.Value('b', 0),
+                                   index_path,
+                                   (mirror, opt, cmd, shell, config)))
+      try:
+        results_it = pool.imap_unordered(
+           DoWorkWrapper,
+           self.ProjectArgs(count),
+           chunksize=chunksize)
+        pool.close()
+        for r in results_it:
+          rc = rc or r
+          if r != 0 and opt.abort_on_errors:
+            raise Exception('Aborting due to previous error')
+      except (KeyboardInterrupt, WorkerKeyboardInterrupt):
+        # Catch KeyboardInterrupt raised inside and outside of workers
+        print('Interrupted - terminating the pool')
+        pool.terminate()
+        rc = rc or errno.EINTR
+      except Exception as e:
+        # Catch any other exceptions raised
+        print('Got an error, terminating the pool: %s: %s' %
+                (type(e).__name__, e),
+              file=sys.stderr)
+        pool.terminate()
+        rc = rc or getattr(e, 'errno', 1)
+      finally:
+        pool.join()
     finally:
-      pool.join()
+      if index_path:
+        os.remove(index_path)
     if rc != 0:
       sys.exit(rc)
 
-  def ProjectArgs(self, projects, mirror, opt, cmd, shell, config):
-    for cnt, p in enumerate(projects):
+  def _WriteProjectIndex(self, projects):
+    """Write the serialized projects to a temporary file.
+
+    The projects are stored column-wise: one list per _ProjectInfo field,
+    so field names are not repeated per project.  Every worker unpickles
+    the whole table in InitWorker; nothing is mapped or read lazily.
+    Returns the file's path and the number of projects written, which
+    stops at the first project that cannot be serialized.  A Ctrl-C is
+    passed on to the caller, leaving no file behind.
+    """
+    columns = tuple([] for _ in _ProjectInfo._fields)
+    for p in projects:
       try:
-        project = self._SerializeProject(p)
+        info = self._SerializeProject(p)
       except Exception as e:
         print('Project list error on project %s: %s: %s' %
                 (p.name, type(e).__name__, e),
               file=sys.stderr)
-        return
+        break
       except KeyboardInterrupt:
         print('Project list interrupted',
               file=sys.stderr)
-        return
-      yield [mirror, opt, cmd, shell, cnt, config, project]
+        raise
+      for column, value in zip(columns, info):
+        column.append(value)
+
+    fd, path = tempfile.mkstemp(prefix='repo-forall-')
+    written = False
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        pickle.dump(columns, f, pickle.HIGHEST_PROTOCOL)
+      written = True
+    finally:
+      if not written:
+        os.remove(path)
+    return path, len(columns[0])
+
+  def ProjectArgs(self, count):
+    return range(count)
 
 class WorkerKeyboardInterrupt(Exception):
   """ Keyboard interrupt exception for worker processes. """
   pass
 
 
-def InitWorker():
+def InitWorker(header_printed, index_path, work_args):
+  global _header_printed
+  global _project_columns
+  global _work_args
   signal.signal(signal.SIGINT, signal.SIG_IGN)
+  _header_printed = header_printed
+  _work_args = work_args
+  with open(index_path, 'rb') as f:
+    _project_columns = pickle.load(f)
+
+def _ProjectAt(cnt):
+  return _ProjectInfo(*[column[cnt] for column in _project_columns])
 
-def DoWorkWrapper(args):
+def DoWorkWrapper(cnt):
   """ A wrapper around the DoWork() method.
 
   Catch the KeyboardInterrupt exceptions here and re-raise them as a different,
@@ -287,120 +373,167 @@ def DoWorkWrapper(args):
   and making the parent hang indefinitely.
 
   """
-  project = args.pop()
+  project = _ProjectAt(cnt)
+  mirror, opt, cmd, shell, config = _work_args
   try:
-    return DoWork(project, *args)
+    return DoWork(project, mirror, opt, cmd, shell, cnt, config)
   except KeyboardInterrupt:
-    print('%s: Worker interrupted' % project['name'])
+    print('%s: Worker interrupted' % project.name)
     raise WorkerKeyboardInterrupt()
 
 
-def DoWork(project, mirror, opt, cmd, shell, cnt, config):
-  env = os.environ.copy()
-  def setenv(name, val):
+def _GetPersistentShell():
+  global _persistent_shell
+  if _persistent_shell is None or not _persistent_shell.IsAlive():
+    _persistent_shell = portable.PersistentShell()
+  return _persistent_shell
+
+
+def _ReadPipes(p):
+  """Yield (std_name, buf) chunks from a child's stdout and stderr."""
+  # class sfd(object):
+  #   def __init__(self, fd, dest):
+  #     self.fd = fd
+  #     self.dest = dest
+  #   def fileno(self):
+  #     return self.fd.fileno()
+
+  p.stdin.close()
+  # s_in = [sfd(p.stdout, sys.stdout),
+  #         sfd(p.stderr, sys.stderr)]
+  s_in = [portable.input_reader(p.stdout, sys.stdout, 'stdout'),
+          portable.input_reader(p.stderr, sys.stderr, 'stderr')]
+
+  for s, buf in portable.read_pipes(s_in):
+    yield s.std_name, buf
+  for s in s_in:
+    # s.fd.close()
+    s.close()
+
+
+def _BinaryStream(f):
+  """Return the byte stream under a text stream such as sys.stdout."""
+  return getattr(f, 'buffer', f)
+
+
+def _SetEnviron(env):
+  """Apply env to os.environ and return the values it replaced.
+
+  A value of None removes the variable, so the result can be passed back
+  in to undo the change.
+  """
+  saved = {}
+  for name, val in env.items():
+    saved[name] = os.environ.get(name)
     if val is None:
-      val = ''
-    if hasattr(val, 'encode'):
-      val = val.encode()
-    env[name] = val
-
-  setenv('REPO_PROJECT', project['name'])
-  setenv('REPO_PATH', project['relpath'])
-  setenv('REPO_REMOTE', project['remote_name'])
-  setenv('REPO_LREV', project['lrev'])
-  setenv('REPO_RREV', project['rrev'])
-  setenv('REPO_I', str(cnt + 1))
-  for name in project['annotations']:
-    setenv("REPO__%s" % (name), project['annotations'][name])
+      os.environ.pop(name, None)
+      continue
+    if not is_python3() and not isinstance(val, str):
+      val = val.encode('utf-8')
+    os.environ[name] = val
+  return saved
+
+
+def DoWork(project, mirror, opt, cmd, shell, cnt, config):
+  repo_env = {
+    'REPO_PROJECT': project.name,
+    'REPO_PATH': project.relpath,
+    'REPO_REMOTE': project.remote_name,
+    'REPO_LREV': project.lrev,
+    'REPO_RREV': project.rrev,
+    'REPO_I': str(cnt + 1),
+  }
+  repo_env.update(('REPO__%s' % name, value)
+                  for name, value in project.annotations.items())
 
   if mirror:
-    setenv('GIT_DIR', project['gitdir'])
-    cwd = project['gitdir']
+    repo_env['GIT_DIR'] = project.gitdir
+    cwd = project.gitdir
   else:
-    cwd = project['worktree']
+    cwd = project.worktree
 
   if not os.path.exists(cwd):
     if (opt.project_header and opt.verbose) \
     or not opt.project_header:
-      print('skipping %s/' % project['relpath'], file=sys.stderr)
+      print('skipping %s/' % project.relpath, file=sys.stderr)
     return
 
-  if opt.project_header:
-    stdin = subprocess.PIPE
-    stdout = subprocess.PIPE
-    stderr = subprocess.PIPE
+  # Only -p output can go through the persistent shell: without it the
+  # command must inherit the terminal's stdin, stdout and stderr.
+  persistent = opt.project_header \
+    and portable.isUnix() \
+    and all(_SHELL_NAME_RE.match(name) for name in repo_env)
+
+  if persistent:
+    sh = _GetPersistentShell()
+    chunks = sh.Run(cmd, shell, cwd, repo_env)
   else:
-    stdin = None
-    stdout = None
-    stderr = None
-
-  p = subprocess.Popen(cmd,
-                       cwd=cwd,
-                       shell=shell,
-                       env=env,
-                       stdin=stdin,
-                       stdout=stdout,
-                       stderr=stderr)
+    if opt.project_header:
+      stdin = subprocess.PIPE
+      stdout = subprocess.PIPE
+      stderr = subprocess.PIPE
+    else:
+      stdin = None
+      stdout = None
+      stderr = None
+
+    # Workers run one project at a time, so rather than copying the whole
+    # environment per project, set the REPO_* variables in our own
+    # environment for the child to inherit and put them back afterwards.
+    saved = _SetEnviron(repo_env)
+    try:
+      p = subprocess.Popen(cmd,
+                           cwd=cwd,
+                           shell=shell,
+                           stdin=stdin,
+                           stdout=stdout,
+                           stderr=stderr)
+    finally:
+      _SetEnviron(saved)
+    if opt.project_header:
+      chunks = _ReadPipes(p)
 
   if opt.project_header:
     out = ForallColoring(config)
     out.redirect(sys.stdout)
-    # class sfd(object):
-    #   def __init__(self, fd, dest):
-    #     self.fd = fd
-    #     self.dest = dest
-    #   def fileno(self):
-    #     return self.fd.fileno()
 
     empty = True
-    errbuf = ''
-
-    p.stdin.close()
-    # s_in = [sfd(p.stdout, sys.stdout),
-    #         sfd(p.stderr, sys.stderr)]
-    s_in = [portable.input_reader(p.stdout, sys.stdout, 'stdout'),
-            portable.input_reader(p.stderr, sys.stderr, 'stderr')]
-
-    # for s in s_in:
-    #   flags = fcntl.fcntl(s.fd, fcntl.F_GETFL)
-    #   fcntl.fcntl(s.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-
-    while s_in:
-      in_ready, _out_ready, _err_ready = select.select(s_in, [], [])
-      for s in in_ready:
-        # buf = s.fd.read(4096)
-        buf = s.read(4096)
-        if not buf:
-          # s.fd.close()
-          s.close()
-          s_in.remove(s)
+    errbuf = bytearray()
+
+    for std_name, buf in chunks:
+      if not opt.verbose and empty:
+        if std_name != 'stdout':
+          errbuf.extend(buf)
           continue
 
-        if not opt.verbose:
-          # if s.fd != p.stdout:
-          if s.src != p.stdout:
-            errbuf += buf
-            continue
-
-        if empty and out:
-          if not cnt == 0:
-            out.nl()
-
-          if mirror:
-            project_header_path = project['name']
-          else:
-            project_header_path = project['relpath']
-          out.project('project %s/', project_header_path)
+      if empty and out:
+        # Projects may finish out of order, so separate headers based on
+        # whether any header was printed before rather than on cnt.
+        with _header_printed.get_lock():
+          first = not _header_printed.value
+          _header_printed.value = 1
+        if not first:
           out.nl()
-          out.flush()
-          if errbuf:
-            sys.stderr.write(errbuf)
-            sys.stderr.flush()
-            errbuf = ''
-          empty = False
-
-        s.dest.write(buf)
-        s.dest.flush()
 
+        if mirror:
+          project_header_path = project.name
+        else:
+          project_header_path = project.relpath
+        out.project('project %s/', project_header_path)
+        out.nl()
+        out.flush()
+        if errbuf:
+          err = _BinaryStream(sys.stderr)
+          err.write(errbuf)
+          err.flush()
+          del errbuf[:]
+        empty = False
+
+      dest = _BinaryStream(sys.stdout if std_name == 'stdout' else sys.stderr)
+      dest.write(buf)
+      dest.flush()
+
+  if persistent:
+    return sh.rc
   r = p.wait()
   return r
@@ -16,7 +16,6 @@
 from __future__ import print_function
 import os
 import platform
-import re
 import shutil
 import sys
 
@@ -36,6 +35,9 @@ from project import SyncBuffer
 from git_config import GitConfig
 from git_command import git_require, MIN_GIT_VERSION
 
+# Ordered, since --platform=all adds the groups in this order.
+_ALL_PLATFORMS = ('linux', 'darwin', 'windows')
+
 class Init(InteractiveCommand, MirrorSafeCommand):
   common = True
   helpSummary = "Initialize repo in the current directory"
@@ -186,22 +188,20 @@ to update the working directory files.
       r.ResetFetch()
       r.Save()
 
-    groups = re.split(r'[,\s]+', opt.groups)
-    all_platforms = ['linux', 'darwin', 'windows']
+    groups = opt.groups.replace(',', ' ').split()
     platformize = lambda x: 'platform-' + x
     if opt.platform == 'auto':
       if (not opt.mirror and
           not m.config.GetString('repo.mirror') == 'true'):
         groups.append(platformize(platform.system().lower()))
     elif opt.platform == 'all':
-      groups.extend(map(platformize, all_platforms))
-    elif opt.platform in all_platforms:
+      groups.extend(map(platformize, _ALL_PLATFORMS))
+    elif opt.platform in _ALL_PLATFORMS:
       groups.append(platformize(opt.platform))
     elif opt.platform != 'none':
       print('fatal: invalid platform flag', file=sys.stderr)
       sys.exit(1)
 
-    groups = [x for x in groups if x]
     groupstr = ','.join(groups)
     if opt.platform == 'auto' and groupstr == 'default,platform-' + platform.system().lower():
       groupstr = None
@@ -238,7 +238,7 @@ to update the working directory files.
       # Better delete the manifest git dir if we created it; otherwise next
       # time (when user fixes problems) we won't go through the "is_new" logic.
       if is_new:
-        portable.rmtree(m.gitdir)
+        portable.fast_rmtree(m.gitdir)
       sys.exit(1)
 
     if opt.manifest_branch:
@@ -14,16 +14,39 @@
 # limitations under the License.
 
 from __future__ import print_function
+import errno
+import multiprocessing
 import os
 import sys
+from time import time
+try:
+  import threading as _threading
+except ImportError:
+  import dummy_threading as _threading
 
 from command import Command
+from error import GitError
 from git_config import IsId
-from git_command import git
+from git_refs import CheckRefFormat
 import gitc_utils
 from progress import Progress
 from project import SyncBuffer
 
+# Written into a GITC project's .git directory once it has been synced.
+_SYNCED_MARKER = 'repo_start_synced'
+
+_is_id_cache = {}
+
+
+def _IsId(rev):
+  """IsId, remembering the answer for each revision seen."""
+  try:
+    return _is_id_cache[rev]
+  except KeyError:
+    r = _is_id_cache[rev] = bool(IsId(rev))
+    return r
+
+
 class Start(Command):
   common = True
   helpSummary = "Start a new branch for development"
@@ -36,20 +59,133 @@ revision specified in the manifest.
 """
 
   def _Options(self, p):
+    try:
+      self.jobs = max(1, multiprocessing.cpu_count() * 3 // 4)
+    except NotImplementedError:
+      self.jobs = 1
+
     p.add_option('--all',
                  dest='all', action='store_true',
                  help='begin branch in all projects')
+    p.add_option('-j', '--jobs',
+                 dest='jobs', action='store', type='int', default=self.jobs,
+                 help="projects to start simultaneously (default %d)"
+                      % self.jobs)
+
+  def _StartBranch(self, project, nb, branch_merge, failed, lock, pm, sem):
+    """Start branch nb in one project, recording whether it failed."""
+    try:
+      try:
+        ok = project.StartBranch(nb, branch_merge=branch_merge)
+      except Exception as e:
+        print('error: %s/: %s: %s' % (project.relpath, type(e).__name__, e),
+              file=sys.stderr)
+        ok = False
+      with lock:
+        if not ok:
+          failed.add(project)
+        # Redrawing the progress line for every project serializes the
+        # threads on terminal I/O; only pass on completions in batches.
+        self._pm_pending += 1
+        now = time()
+        if (self._pm_pending >= self._pm_step or
+            now - self._pm_last > 0.1):
+          pm.update(inc=self._pm_pending)
+          self._pm_pending = 0
+          self._pm_last = now
+    finally:
+      sem.release()
+
+  def _IsGitcSynced(self, project, revision):
+    """Whether an earlier start already synced project to revision.
+
+       A marker in the work tree's .git directory records the revision of
+       the last complete sync, so that rerunning start after a partial
+       failure does not sync the same projects again.
+    """
+    marker = os.path.join(project.worktree, '.git', _SYNCED_MARKER)
+    try:
+      with open(marker) as fd:
+        return fd.read().strip() == revision
+    except IOError:
+      return False
+
+  def _NeedsFetch(self, project, revision):
+    """Whether revision has to be fetched before project can be checked out.
+
+       A work tree left behind by an earlier run only needs its checkout
+       redone, provided the revision is already present locally.
+    """
+    if not revision:
+      return True
+    if not os.path.isdir(os.path.join(project.worktree, '.git')):
+      return True
+    try:
+      project.bare_git.rev_parse('--verify', '%s^0' % revision)
+    except GitError:
+      return True
+    return False
+
+  def _FetchHelper(self, project, lock, pm, sem):
+    """Fetch one GITC project, then release its slot in sem."""
+    try:
+      project.Sync_NetworkHalf()
+      with lock:
+        pm.update()
+    finally:
+      sem.release()
+
+  def _SyncGitcProjects(self, to_sync, jobs, mp_config):
+    """Check out the work trees of GITC projects that have not been opened.
+
+       Fetching is network bound, so it runs on up to jobs threads; the
+       checkouts then run one at a time.
+    """
+    pending = [(project, revision) for project, revision in to_sync
+               if not self._IsGitcSynced(project, revision)]
+    to_fetch = [project for project, revision in pending
+                if self._NeedsFetch(project, revision)]
+
+    pm = Progress('Fetching projects', len(to_fetch))
+    lock = _threading.Lock()
+    sem = _threading.Semaphore(jobs)
+    threads = set()
+    for project in to_fetch:
+      sem.acquire()
+      if jobs > 1:
+        t = _threading.Thread(target=self._FetchHelper,
+                              args=(project, lock, pm, sem))
+        # Ensure that Ctrl-C will not freeze the repo process.
+        t.daemon = True
+        threads.add(t)
+        t.start()
+      else:
+        self._FetchHelper(project, lock, pm, sem)
+    for t in threads:
+      t.join()
+    pm.end()
+
+    for project, revision in pending:
+      sync_buf = SyncBuffer(mp_config)
+      project.Sync_LocalHalf(sync_buf)
+      if sync_buf.clean:
+        marker = os.path.join(project.worktree, '.git', _SYNCED_MARKER)
+        with open(marker, 'w') as fd:
+          fd.write('%s\n' % revision)
 
   def Execute(self, opt, args):
     if not args:
       self.Usage()
 
+    # As with sync, a --jobs of 0 (or less) means the default.
+    if opt.jobs < 1:
+      opt.jobs = self.jobs
+
     nb = args[0]
-    if not git.check_ref_format('heads/%s' % nb):
-      print("error: '%s' is not a valid name" % nb, file=sys.stderr)
+    if not CheckRefFormat('heads/%s' % nb):
+      sys.stderr.write("error: '%s' is not a valid name\n" % nb)
       sys.exit(1)
 
-    err = []
     projects = []
     if not opt.all:
       projects = args[1:]
@@ -62,8 +198,11 @@ revision specified in the manifest.
     # This must happen after we find all_projects, since GetProjects may need
     # the local directory, which will disappear once we save the GITC manifest.
     if self.gitc_manifest:
-      gitc_projects = self.GetProjects(projects, manifest=self.gitc_manifest,
-                                       missing_ok=True)
+      # Every project being started also exists in the GITC manifest at the
+      # same path, so look them up there rather than resolving the project
+      # arguments against the manifest a second time.
+      gitc_paths = self.gitc_manifest.paths
+      gitc_projects = [gitc_paths[p.relpath] for p in all_projects]
       for project in gitc_projects:
         if project.old_revision:
           project.already_synced = True
@@ -75,43 +214,93 @@ revision specified in the manifest.
       gitc_utils.save_manifest(self.gitc_manifest)
 
       # Make sure we have a valid CWD
-      if not os.path.exists(os.getcwd()):
+      try:
+        os.getcwd()
+      except OSError:
         os.chdir(self.manifest.topdir)
 
+    # These do not change from one project to the next.
+    is_id = _IsId
+    default_rev = self.manifest.default.revisionExpr
+    mp_config = self.manifest.manifestProject.config
+    gitc = self.gitc_manifest
+    gitc_paths = gitc.paths if gitc else {}
+    gitc_dir = gitc.gitc_client_dir if gitc else None
+
+    # Check out the GITC projects that have not been opened yet before any
+    # branches are started in them.
+    if gitc:
+      to_sync = []
+      # relpaths are relative to the client dir, so joining them to it
+      # only needs a string concatenation once the separator is in place.
+      gitc_prefix = os.path.join(gitc_dir, '')
+      for project in all_projects:
+        gitc_project = gitc_paths[project.relpath]
+        if gitc_project.already_synced:
+          continue
+        proj_localdir = gitc_prefix + project.relpath
+        project.worktree = proj_localdir
+        try:
+          os.makedirs(proj_localdir)
+        except OSError as e:
+          if e.errno != errno.EEXIST:
+            raise
+        to_sync.append((project, gitc_project.old_revision))
+      self._SyncGitcProjects(to_sync, opt.jobs, mp_config)
+      for project, revision in to_sync:
+        project.revisionId = revision
+
     pm = Progress('Starting %s' % nb, len(all_projects))
-    for project in all_projects:
-      pm.update()
-
-      if self.gitc_manifest:
-        gitc_project = self.gitc_manifest.paths[project.relpath]
-        # Sync projects that have not been opened.
-        if not gitc_project.already_synced:
-          proj_localdir = os.path.join(self.gitc_manifest.gitc_client_dir,
-                                       project.relpath)
-          project.worktree = proj_localdir
-          if not os.path.exists(proj_localdir):
-            os.makedirs(proj_localdir)
-          project.Sync_NetworkHalf()
-          sync_buf = SyncBuffer(self.manifest.manifestProject.config)
-          project.Sync_LocalHalf(sync_buf)
-          project.revisionId = gitc_project.old_revision
+    self._pm_pending = 0
+    self._pm_step = max(1, len(all_projects) // 200)
+    self._pm_last = time()
+    failed = set()
+    lock = _threading.Lock()
+    sem = _threading.Semaphore(opt.jobs)
+    threads = set()
+    merge_cache = {}
 
+    for project in all_projects:
       # If the current revision is a specific SHA1 then we can't push back
       # to it; so substitute with dest_branch if defined, or with manifest
       # default revision instead.
-      branch_merge = ''
-      if IsId(project.revisionExpr):
-        if project.dest_branch:
-          branch_merge = project.dest_branch
-        else:
-          branch_merge = self.manifest.default.revisionExpr
+      # Most projects share a revision and dest-branch, so only work this
+      # out once for each combination.
+      key = (project.revisionExpr, project.dest_branch)
+      try:
+        branch_merge = merge_cache[key]
+      except KeyError:
+        branch_merge = ''
+        if is_id(project.revisionExpr):
+          branch_merge = project.dest_branch or default_rev
+        merge_cache[key] = branch_merge
+
+      sem.acquire()
+      kwargs = dict(project=project,
+                    nb=nb,
+                    branch_merge=branch_merge,
+                    failed=failed,
+                    lock=lock,
+                    pm=pm,
+                    sem=sem)
+      if opt.jobs > 1:
+        t = _threading.Thread(target=self._StartBranch, kwargs=kwargs)
+        # Ensure that Ctrl-C will not freeze the repo process.
+        t.daemon = True
+        threads.add(t)
+        t.start()
+      else:
+        self._StartBranch(**kwargs)
 
-      if not project.StartBranch(nb, branch_merge=branch_merge):
-        err.append(project)
+    for t in threads:
+      t.join()
+    if self._pm_pending:
+      pm.update(inc=self._pm_pending)
     pm.end()
 
+    err = [p for p in all_projects if p in failed]
     if err:
-      for p in err:
-        print("error: %s/: cannot start %s" % (p.relpath, nb),
-              file=sys.stderr)
+      sys.stderr.write(''.join('error: %s/: cannot start %s\n' % (p.relpath, nb)
+                               for p in err))
+      sys.stderr.flush()
       sys.exit(1)
@@ -0,0 +1,140 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import git_config  # imported first to break its cycle with git_command
+import git_command
+from error import GitError
+
+def _git(gitdir, *args, **kwargs):
+  env = dict(os.environ,
+             GIT_DIR=gitdir,
+             GIT_AUTHOR_NAME='A U Thor',
+             GIT_AUTHOR_EMAIL='author@example.com',
+             GIT_COMMITTER_NAME='A U Thor',
+             GIT_COMMITTER_EMAIL='author@example.com')
+  p = subprocess.Popen(['git'] + list(args), env=env,
+                       stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  out = p.communicate(kwargs.get('input'))[0]
+  assert p.returncode == 0, args
+  return out.decode('utf-8').strip()
+
+class GitBatchCatUnitTest(unittest.TestCase):
+  """Tests the GitBatchCat class and the batch_cat() registry.
+  """
+  def setUp(self):
+    """Create a bare repository holding one commit of one file.
+    """
+    self.tempdir = tempfile.mkdtemp(prefix='repo-batch-cat-')
+    self.gitdir = self._MakeRepo('a.git')
+
+  def tearDown(self):
+    git_command.terminate_batch_cats()
+    shutil.rmtree(self.tempdir)
+
+  def _MakeRepo(self, name):
+    gitdir = os.path.join(self.tempdir, name)
+    subprocess.check_call(['git', 'init', '-q', '--bare', gitdir])
+    self.blob = _git(gitdir, 'hash-object', '-w', '--stdin',
+                     input=b'hello\n')
+    tree = _git(gitdir, 'mktree',
+                input=('100644 blob %s\tREADME\n' % self.blob).encode())
+    commit = _git(gitdir, 'commit-tree', '-m', 'init', tree)
+    _git(gitdir, 'update-ref', 'refs/heads/master', commit)
+    self.commit = commit
+    return gitdir
+
+  def test_Resolve(self):
+    """Refs and revision expressions resolve to (name, type, size).
+    """
+    cat = git_command.GitBatchCat(self.gitdir)
+    try:
+      name, objtype, _ = cat.Resolve('refs/heads/master')
+      self.assertEqual((name, objtype), (self.commit, 'commit'))
+      self.assertEqual(cat.Resolve('HEAD^0')[0], self.commit)
+      self.assertEqual(cat.Resolve('master:README'),
+                       (self.blob, 'blob', 6))
+    finally:
+      cat.Close()
+
+  def test_Read(self):
+    """Read returns the type and the exact contents of an object.
+    """
+    cat = git_command.GitBatchCat(self.gitdir)
+    try:
+      self.assertEqual(cat.Read(self.blob), ('blob', b'hello\n'))
+      # The stream stays in step for the next query.
+      self.assertEqual(cat.Read('master')[0], 'commit')
+    finally:
+      cat.Close()
+
+  def test_missing_objects(self):
+    """Unknown names give None and leave the process usable.
+    """
+    cat = git_command.GitBatchCat(self.gitdir)
+    try:
+      self.assertEqual(cat.Resolve('refs/heads/nope'), None)
+      self.assertEqual(cat.Read('0' * 40), None)
+      self.assertEqual(cat.Resolve('a\nb'), None)
+      self.assertEqual(cat.Resolve('master')[0], self.commit)
+    finally:
+      cat.Close()
+
+  def test_Close(self):
+    """Close stops the cat-file processes and refuses further queries.
+    """
+    cat = git_command.GitBatchCat(self.gitdir)
+    cat.Resolve('master')
+    cat.Read('master')
+    procs = list(cat._procs.values())
+    cat.Close()
+    self.assertEqual(cat._procs, {})
+    for p in procs:
+      self.assertNotEqual(p.returncode, None)
+      self.assertTrue(p.stdin.closed and p.stdout.closed)
+    self.assertRaises(GitError, cat.Resolve, 'master')
+
+  def test_batch_cat_evicts_least_recently_used(self):
+    """Only the most recently used gitdirs keep a running cat-file.
+    """
+    commit = self.commit
+    first = git_command.batch_cat(self.gitdir)
+    first.Resolve('master')
+    count = git_command._BATCH_CAT_MAX + 2
+    for i in range(count):
+      gitdir = self._MakeRepo('r%d.git' % i)
+      self.assertEqual(git_command.batch_cat(gitdir).Resolve('HEAD^0')[0],
+                       self.commit)
+    self.assertEqual(len(git_command._batch_cats),
+                     git_command._BATCH_CAT_MAX)
+    self.assertNotIn(self.gitdir, git_command._batch_cats)
+    self.assertEqual(first._procs, {})
+    self.assertRaises(GitError, first.Resolve, 'master')
+
+    # A fresh object is handed out for an evicted gitdir.
+    self.assertEqual(git_command.batch_cat(self.gitdir).Resolve('master')[0],
+                     commit)
+
+    git_command.terminate_batch_cats()
+    self.assertEqual(len(git_command._batch_cats), 0)
+
+class GitCommandUnitTest(unittest.TestCase):
+  """Tests the GitCommand class.
+  """
+  def test_missing_cwd(self):
+    """A cwd that is not a directory raises GitError, however git is run.
+    """
+    tempdir = tempfile.mkdtemp(prefix='repo-git-command-')
+    try:
+      path = os.path.join(tempdir, 'file')
+      open(path, 'w').close()
+      for cwd in (os.path.join(tempdir, 'missing'), path):
+        self.assertRaises(GitError, git_command.GitCommand,
+                          None, ['status'], cwd=cwd)
+    finally:
+      shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+  unittest.main()
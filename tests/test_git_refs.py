@@ -0,0 +1,93 @@
+# -*- coding:utf-8 -*-
+import os
+import subprocess
+import unittest
+
+import git_refs
+
+# (branch name, whether git check-ref-format accepts heads/<name>)
+REF_NAMES = [
+  ('foo', True),
+  ('foo/bar', True),
+  ('-foo', True),
+  ('a.b', True),
+  ('a@b', True),
+  ('a@', True),
+  ('@', True),
+  ('a{b', True),
+  ('lock', True),
+  ('a/b.lock.c', True),
+  (u'ümlaut', True),
+  ('', False),
+  ('.foo', False),
+  ('foo/.bar', False),
+  ('foo.', False),
+  ('foo.lock', False),
+  ('foo.lock.lock', False),
+  ('foo.lock/x', False),
+  ('.lock', False),
+  ('a..b', False),
+  ('a b', False),
+  ('a~b', False),
+  ('a^', False),
+  ('a:b', False),
+  ('a?', False),
+  ('a*', False),
+  ('a[b', False),
+  ('a\\b', False),
+  ('a@{b', False),
+  ('a//b', False),
+  ('a/', False),
+  ('/a', False),
+  ('x\x01', False),
+  ('a\x7f', False),
+  ('a\tb', False),
+]
+
+# (full ref name, whether git check-ref-format accepts it as given)
+FULL_REF_NAMES = [
+  ('heads/x', True),
+  ('refs/heads/x', True),
+  ('@/x', True),
+  ('refs/@/x', True),
+  ('', False),
+  ('foo', False),
+  ('@', False),
+  ('HEAD', False),
+  ('/heads/x', False),
+  ('/', False),
+]
+
+class CheckRefFormatUnitTest(unittest.TestCase):
+  """Tests the in-process CheckRefFormat.
+  """
+  def setUp(self):
+    self.saved = os.environ.pop('REPO_GIT_CHECK_REF_FORMAT', None)
+
+  def tearDown(self):
+    if self.saved is not None:
+      os.environ['REPO_GIT_CHECK_REF_FORMAT'] = self.saved
+
+  def _Names(self):
+    for name, valid in REF_NAMES:
+      yield 'heads/' + name, valid
+    for name, valid in FULL_REF_NAMES:
+      yield name, valid
+
+  def test_names(self):
+    """Each name is accepted or rejected as listed.
+    """
+    for name, valid in self._Names():
+      self.assertEqual(git_refs.CheckRefFormat(name), valid, repr(name))
+
+  def test_names_match_git(self):
+    """The tables agree with the installed git.
+    """
+    for name, valid in self._Names():
+      with open(os.devnull, 'w') as devnull:
+        rc = subprocess.call(['git', 'check-ref-format', name],
+                             stderr=devnull)
+      self.assertEqual(rc == 0, valid, repr(name))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,143 @@
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import portable
+
+def _run(script):
+  """Run a shell script and collect its output through read_pipes()."""
+  p = subprocess.Popen(['/bin/sh', '-c', script],
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE)
+  readers = [portable.input_reader(p.stdout, sys.stdout, 'stdout'),
+             portable.input_reader(p.stderr, sys.stderr, 'stderr')]
+  out = {'stdout': bytearray(), 'stderr': bytearray()}
+  for s, buf in portable.read_pipes(readers):
+    out[s.std_name].extend(buf)
+  for s in readers:
+    s.close()
+  return p.wait(), bytes(out['stdout']), bytes(out['stderr'])
+
+@unittest.skipUnless(portable.isUnix(), 'needs /bin/sh and pipes')
+class ReadPipesUnitTest(unittest.TestCase):
+  """Tests draining a child's pipes with read_pipes().
+  """
+  def test_both_streams(self):
+    """Output on both pipes is delivered to the right reader.
+    """
+    rc, out, err = _run('echo out; echo err >&2; exit 3')
+    self.assertEqual((rc, out, err), (3, b'out\n', b'err\n'))
+
+  def test_no_trailing_newline(self):
+    """A final partial line is not lost.
+    """
+    rc, out, err = _run("printf 'a\\nb'")
+    self.assertEqual((rc, out, err), (0, b'a\nb', b''))
+
+  def test_stderr_only(self):
+    """A stdout that closes with no output does not end the loop early.
+    """
+    rc, out, err = _run("exec >&-; sleep 0.1; printf 'late' >&2")
+    self.assertEqual((rc, out, err), (0, b'', b'late'))
+
+  def test_large_output(self):
+    """More than a pipe buffer's worth of output arrives intact.
+    """
+    size = 3 * 1024 * 1024
+    rc, out, err = _run('head -c %d /dev/zero; head -c %d /dev/zero >&2'
+                        % (size, size + 1))
+    self.assertEqual(rc, 0)
+    self.assertEqual(len(out), size)
+    self.assertEqual(len(err), size + 1)
+    self.assertEqual(out.count(b'\0'), size)
+
+class _SelectOnly(object):
+  """The select module as seen on platforms without epoll."""
+  select = staticmethod(select.select)
+
+class SelectReadPipesUnitTest(ReadPipesUnitTest):
+  """Runs the read_pipes() tests through its select() fallback.
+  """
+  def setUp(self):
+    portable.select = _SelectOnly
+
+  def tearDown(self):
+    portable.select = select
+
+@unittest.skipUnless(portable.isUnix(), 'needs /bin/sh and pipes')
+class PersistentShellUnitTest(unittest.TestCase):
+  """Tests running commands through one PersistentShell.
+  """
+  def setUp(self):
+    self.sh = portable.PersistentShell()
+    self.cwd = tempfile.gettempdir()
+
+  def tearDown(self):
+    p = self.sh.process
+    for f in (p.stdin, p.stdout, p.stderr):
+      f.close()
+    p.wait()
+
+  def _Run(self, cmd, shell=True, env=None):
+    if shell:
+      cmd = [cmd, cmd]
+    out = {'stdout': b'', 'stderr': b''}
+    for std_name, buf in self.sh.Run(cmd, shell, self.cwd, env or {}):
+      out[std_name] += bytes(buf)
+    return self.sh.rc, out['stdout'], out['stderr']
+
+  def test_exit_status(self):
+    """Each command's exit status is reported, and the shell carries on.
+    """
+    self.assertEqual(self._Run('exit 7'), (7, b'', b''))
+    self.assertEqual(self._Run('true'), (0, b'', b''))
+    self.assertEqual(self._Run(['false'], shell=False), (1, b'', b''))
+    self.assertTrue(self.sh.IsAlive())
+
+  def test_no_trailing_newline(self):
+    """Output not ending in a newline is kept apart from the end token.
+    """
+    self.assertEqual(self._Run("printf out; printf err >&2"),
+                     (0, b'out', b'err'))
+    self.assertEqual(self._Run("printf 'a\nb'; exit 2"), (2, b'a\nb', b''))
+
+  def test_stderr_only(self):
+    """A command writing only to stderr is collected in full.
+    """
+    self.assertEqual(self._Run('echo oops >&2; exit 1'),
+                     (1, b'', b'oops\n'))
+
+  def test_large_output(self):
+    """More than 1MB on each stream arrives intact and in order.
+    """
+    size = 3 * 1024 * 1024
+    rc, out, err = self._Run('head -c %d /dev/zero | tr "\\0" a; '
+                             'head -c %d /dev/zero >&2' % (size, size + 1))
+    self.assertEqual(rc, 0)
+    self.assertEqual(out, b'a' * size)
+    self.assertEqual(len(err), size + 1)
+
+  def test_cwd_env_and_args(self):
+    """Commands run in cwd with env and arguments, without leaking state.
+    """
+    rc, out, _ = self._Run(['sh', '-c', 'pwd; echo "$FOO" "$1"', 'x', "it's"],
+                           shell=False, env={'FOO': 'a b'})
+    self.assertEqual(rc, 0)
+    self.assertEqual(out.decode().split('\n')[1:],
+                     ["a b it's", ''])
+    self.assertEqual(os.path.realpath(out.decode().split('\n')[0]),
+                     os.path.realpath(self.cwd))
+    self.assertEqual(self._Run('echo "${FOO-unset}"'), (0, b'unset\n', b''))
+
+  def test_shell_dies(self):
+    """If the shell itself exits, the command fails instead of hanging.
+    """
+    rc, _, _ = self._Run('kill -9 $$')
+    self.assertNotEqual(rc, 0)
+    self.assertFalse(self.sh.IsAlive())
+
+if __name__ == '__main__':
+  unittest.main()